@@ -2,19 +2,42 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import json
+import heapq
 import logging
 import os
+import re
+import shutil
 import sys
 
-from typing import Dict, List, AnyStr
+from itertools import groupby, islice
+from pathlib import Path
+from typing import Dict, List, AnyStr, NamedTuple, Optional, Pattern, Set
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
 
 SUBS = 'subs.json'
 LOG_FILE = 'build_list.log'
+ENCODING = 'utf-8'
+NEWLINE = os.linesep.encode(ENCODING)  # keep the line endings text mode writing used to produce
+BUFFER_SIZE = 1 << 20  # 1 MiB, blacklists can easily grow to several MB
+SECTION_START = re.compile(rb'^[ \t]*###(.*)domains start[ \t\r]*$', re.MULTILINE)
+SECTION_END = re.compile(rb'^[ \t]*###.*domains end[ \t\r]*$', re.MULTILINE)
 
 log = logging.getLogger(__file__)
 
 
+class Substitutions(NamedTuple):
+    """
+    Substitution map compiled for fast application on each parsed (bytes) line.
+    """
+    table: Optional[bytes]
+    values: List[bytes]
+    pattern: Optional[Pattern]
+
+
 def configure_logging(debug: bool = False) -> None:
     """
     Configure logging.
@@ -49,6 +72,9 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('-t', '--target', action='store', dest='target',
                         help='Target filename. If exists, it will be updated with the new content.')
 
+    parser.add_argument('--collapse-subdomains', action='store_true', dest='collapse_subdomains', default=False,
+                        help='Drop domains already covered by a parent domain in the same section.')
+
     parser.add_argument('--run', action='store_true', dest='run', default=False,
                         help='Run the script. Otherwise just quit.')
     parser.add_argument('--debug', action='store_true', dest='debug', default=False, help='Debug mode. Writes a lot.')
@@ -68,124 +94,194 @@ def load_subs(filename: AnyStr) -> Dict[AnyStr, AnyStr]:
     :return: Map of substitutions
     :rtype: Dict[AnyStr, AnyStr]
     """
-    with open(filename, 'r') as f:
-        return json.loads(f.read())
+    # both orjson and json accept bytes, so skip decoding here
+    return _json.loads(Path(filename).read_bytes())
+
+
+def compile_subs(subs: Dict[AnyStr, AnyStr]) -> Substitutions:
+    """
+    Compile the substitution map for fast application on bytes. Single byte to single byte substitutions
+    that do not occur inside any longer key go into a bytes.translate() table, the rest are compiled into a single regex so each line is scanned
+    only once. Each key gets its own group, so a match is replaced by indexing into the list
+    of values with the group number. Longer keys are tried first, so they win over their own prefixes.
+    :param subs: Map of substitutions, as returned by load_subs()
+    :type subs: Dict[AnyStr, AnyStr]
+    :return: Compiled substitutions
+    :rtype: Substitutions
+    """
+    subs = {k.encode(ENCODING): v.encode(ENCODING) for k, v in subs.items() if k}
+    multi = [k for k, v in subs.items() if len(k) > 1 or len(v) != 1]
+    # the table is applied first, so it must not touch bytes that are part of a longer key
+    single = {k: v for k, v in subs.items() if k not in multi and not any(k in m for m in multi)}
+    table = bytes.maketrans(b''.join(single), b''.join(single.values())) if single else None
 
+    keys = sorted((k for k in subs if k not in single), key=len, reverse=True)
+    # regex groups are numbered from 1, pad the list so m.lastindex can be used as is
+    values = [b''] + [subs[k] for k in keys]
+    pattern = re.compile(b'|'.join(b'(' + re.escape(k) + b')' for k in keys)) if keys else None
+    return Substitutions(table=table, values=values, pattern=pattern)
 
-def load_new_data(filename: AnyStr) -> List[AnyStr]:
+
+def load_new_data(filename: AnyStr) -> List[bytes]:
     """
-    Loads new data from the specified filename.
+    Loads new data from the specified filename. The file is read as bytes, skipping the decoding.
     :param filename: File to load data from
     :type filename: AnyStr
     :return: List of parsed lines.
-    :rtype: List[AnyStr]
+    :rtype: List[bytes]
     """
     try:
-        with open(filename, 'r') as f:
+        subs = compile_subs(load_subs(SUBS))
+        with open(filename, 'rb', buffering=BUFFER_SIZE) as f:
             data = []
-            lines = f.readlines()
-            for line in lines:
-                data.append(parse_line(line))
+            for line in f:
+                data.append(parse_line(line, subs))
             return data
     except Exception as e:
-        log.error(f'Could not load "{filename}": {e}')
+        log.error('Could not load "%s": %s', filename, e)
         return []
 
 
-def parse_line(line: AnyStr) -> AnyStr:
+def parse_line(line: bytes, subs: Substitutions) -> bytes:
     """
     Parses a line to apply the following transformations:
     - Take the part of the line just up until the first space character (assumes space-separated lines format)
     - Apply substitiutions as defined in the substitutions file.
     :param line: A line to parse
-    :type line: AnyStr
-    :return: Returns a parsed line
-    :rtype: AnyStr
+    :type line: bytes
+    :param subs: Substitutions, as returned by compile_subs()
+    :type subs: Substitutions
+    :return: Returns a parsed line, without a trailing newline
+    :rtype: bytes
     """
     # assume ' '-separated domain is the first word in the line
-    if ' ' in line:
-        line = line.split(' ')[0]
-    line = line.strip()
+    line = line.partition(b' ')[0].strip()
 
     # do substitutions
-    for orig, sub in load_subs(SUBS).items():
-        line = line.replace(orig, sub)
+    if subs.table is not None:
+        line = line.translate(subs.table)
+    if subs.pattern:
+        values = subs.values
+        line = subs.pattern.sub(lambda m: values[m.lastindex], line)
 
     return line
 
 
-def parse_target(target_file: AnyStr) -> Dict[AnyStr, Dict[AnyStr, List[AnyStr]]]:
+def merge_entries(items: List[bytes], new_entries: Set[bytes]) -> List[bytes]:
+    """
+    Merges new entries into the existing items, returning a sorted list of unique entries.
+    Existing items are usually already sorted (this tool writes them that way), in which case
+    they are merged with the sorted new entries without building a set of all the entries.
+    :param items: Existing entries of a section
+    :type items: List[bytes]
+    :param new_entries: Entries to add to the section
+    :type new_entries: Set[bytes]
+    :return: Sorted list of unique entries
+    :rtype: List[bytes]
+    """
+    if all(a <= b for a, b in zip(items, islice(items, 1, None))):
+        return [entry for entry, _ in groupby(heapq.merge(items, sorted(new_entries)))]
+
+    return sorted(new_entries.union(items))
+
+
+def collapse_subdomains(entries: List[bytes]) -> List[bytes]:
+    """
+    Removes entries covered by a parent domain present in the same list
+    (eg: "foo.bar.example.com" is dropped if "bar.example.com" is present).
+    :param entries: List of domains
+    :type entries: List[bytes]
+    :return: List of domains without the covered subdomains, in the original order
+    :rtype: List[bytes]
+    """
+    lookup = set(entries)
+    result = []
+    for entry in entries:
+        parent = entry.partition(b'.')[2]
+        while parent:
+            if parent in lookup:
+                break
+            parent = parent.partition(b'.')[2]
+        else:
+            result.append(entry)
+    return result
+
+
+def parse_target(target_file: AnyStr) -> Dict[str, Dict[str, List[bytes]]]:
     """
     Parses the target file for existing sections and their corresponding entries.
     The returned data will have a section name as the first level key and a dictionary
     with 'items' and 'comments' keys as value. Both 'items' and 'comments' values are
-    lists of AnyStr.
+    lists of bytes (the file is never decoded), stripped of surrounding whitespace
+    (including the trailing newline). Only the section names are decoded to str.
+    A section name is everything between the leading "#" characters and "domains start", so it can span
+    several words. Sections without a name are skipped.
     :param target_file: Filename of the file to read from
     :type target_file: AnyStr
     :return: A map with section names as the key and section data as value
-    :rtype: Dict[AnyStr, Dict[AnyStr, List[AnyStr]]]
+    :rtype: Dict[str, Dict[str, List[bytes]]]
     """
-    result = {}
-    current_section_name = None
-    with open(target_file, 'r') as f:
-        lines = f.readlines()
-
-    for line in lines:
-        line = line.strip()
-        if line.startswith('###') and line.endswith('domains start'):
-            try:
-                current_section_name = line.split(' ')[1]
-                result[current_section_name] = {'items': [], 'comments': []}
-                continue
-            except Exception as e:
-                log.error(f'Could not identify section start: {e}')
-                continue
-
-        if line.startswith('###') and line.endswith('domains end'):
-            current_section_name = None
-            continue
+    # target lists are small enough to be read in one go and split on section headers
+    chunks = SECTION_START.split(Path(target_file).read_bytes())
 
-        if line.startswith('#') and current_section_name:
-            result[current_section_name]['comments'].append(line)
+    # chunks alternate between section names and section bodies, the first chunk precedes any section
+    result = {}
+    for name, body in zip(chunks[1::2], chunks[2::2]):
+        section_name = b' '.join(name.lstrip(b'#').split()).decode(ENCODING)
+        if not section_name:
+            log.error('Could not identify section start: "###%sdomains start" has no section name, section skipped.',
+                      name.decode(ENCODING))
             continue
 
-        if line and current_section_name:
-            result[current_section_name]['items'].append(line.strip())
+        lines = [line.strip() for line in SECTION_END.split(body, 1)[0].splitlines()]
+        result[section_name] = {'items': [line for line in lines if line and not line.startswith(b'#')],
+                                'comments': [line for line in lines if line.startswith(b'#')]}
 
-    log.debug(result)
+    log.debug('Parsed target data: %s', result)
     return result
 
 
-def write_data(data: Dict[AnyStr, Dict[AnyStr, List[AnyStr]]], target: AnyStr) -> None:
+def write_data(data: Dict[str, Dict[str, List[bytes]]], target: AnyStr) -> None:
     """
-    Write the data structure to the blacklist file.
+    Write the data structure to the blacklist file. The data is written to a temporary file next to the
+    target first, which then replaces the target, so an interrupted run never leaves a partial list behind.
+    Symlinks are followed and the file mode of the existing target is kept.
+    Comments and items are expected as bytes without trailing newlines, as returned by parse_target() and parse_line().
+    Lines are terminated with os.linesep, same as with a file opened in text mode.
     :param data: Data to write.
-    :type data: Dict[AnyStr, Dict[AnyStr, List[AnyStr]]]
+    :type data: Dict[str, Dict[str, List[bytes]]]
     :param target:
     :type target: AnyStr
     :return:
     :rtype: None
     """
-    with open(target, 'w') as f:
-        for section, section_data in data.items():
-            log.debug(f'Writing section "{section}".')
-            f.write(f'\n### {section} domains start\n')
-
-            for comment_line in section_data['comments']:
-                if not comment_line.endswith('\n'):
-                    comment_line += '\n'
-                f.write(comment_line)
-            f.write('\n')
-
-            for line in section_data['items']:
-                if not line.endswith('\n'):
-                    line += '\n'
-                f.write(line)
-
-            f.write('\n')
-            f.write(f'### {section} domains end\n')
-            log.debug('Done')
-        log.debug('All done')
+    # write next to the file a symlinked target points to, so the link itself is kept
+    target = os.path.realpath(target)
+    tmp_target = f'{target}.tmp'
+    try:
+        with open(tmp_target, 'wb', buffering=BUFFER_SIZE) as f:
+            for section, section_data in data.items():
+                log.debug('Writing section "%s".', section)
+                # build the whole section in memory and write it in one go
+                lines = [b'',
+                         f'### {section} domains start'.encode(ENCODING),
+                         *section_data['comments'],
+                         b'',
+                         *section_data['items'],
+                         b'',
+                         f'### {section} domains end'.encode(ENCODING)]
+                f.write(NEWLINE.join(lines) + NEWLINE)
+                log.debug('Done')
+
+        if os.path.exists(target):
+            shutil.copymode(target, tmp_target)
+        os.replace(tmp_target, target)
+    except BaseException:
+        if os.path.exists(tmp_target):
+            os.unlink(tmp_target)
+        raise
+
+    log.debug('All done')
 
 
 def main() -> None:
@@ -195,42 +291,51 @@ def main() -> None:
         quit(0)
 
     if args.target and not os.path.exists(args.target):
-        log.info(f'Target file "{args.target}" does not exist and will be created.')
+        log.info('Target file "%s" does not exist and will be created.', args.target)
         with open(args.target, 'w') as f:
             print('', file=f)
 
     data = parse_target(args.target)
+    section_found = args.section in data
 
-    if args.section in data.keys():
-        log.info(f'Section "{args.section}" found in "{args.target}" and will be updated.')
+    if section_found:
+        log.info('Section "%s" found in "%s" and will be updated.', args.section, args.target)
         initial_record_count = len(data[args.section]['items'])
-        log.debug(f'Initial count of section "{args.section}" is: {initial_record_count}.')
+        log.debug('Initial count of section "%s" is: %d.', args.section, initial_record_count)
 
     else:
-        log.info(f'Section "{args.section}" was not found in "{args.target}". New section will be created.')
+        log.info('Section "%s" was not found in "%s". New section will be created.', args.section, args.target)
         data[args.section] = {'items': [], 'comments': []}
         initial_record_count = 0
 
-    # set of entries from update file
+    # set of entries from update file, without the empty ones left by blank lines
     new_entries = set(load_new_data(args.filename))
+    new_entries.discard(b'')
+    log.debug('Loaded %d new records.', len(new_entries))
+
+    # nothing new to add, so skip merging and rewriting the target file
+    if section_found and not args.collapse_subdomains and not new_entries.difference(data[args.section]['items']):
+        log.info('No new records for the section "%s", "%s" is left unchanged.', args.section, args.target)
+        log.info('All done!')
+        return
+
+    # sorted union with the entries already present in the list
+    all_entries = merge_entries(data[args.section]['items'], new_entries)
+    merged_count = len(all_entries)
+    if args.collapse_subdomains:
+        all_entries = collapse_subdomains(all_entries)
+    updated_count = len(all_entries)
 
-    # set of entries already present in the list
-    all_entries = set(data[args.section]['items'])
-    log.debug(f'Loaded {len(new_entries)} new records.')
-
-    # union
-    all_entries.update(new_entries)
-
-    # create a sorted list of entries
-    all_entries = sorted(all_entries)
     data[args.section]['items'] = all_entries
-    updated_count = len(all_entries)
 
-    log.debug(f'Updated record count is: {updated_count}')
-    log.debug(f'Updated data: {data}')
-    log.info(f'Added {updated_count - initial_record_count} new unique records to the section "{args.section}" in file '
-             f'"{args.target}".')
-    log.info(f'Writing data to "{args.target}"...')
+    log.debug('Updated record count is: %d', updated_count)
+    log.debug('Updated data: %s', data)
+    log.info('Added %d new unique records to the section "%s" in file "%s".',
+             merged_count - initial_record_count, args.section, args.target)
+    if args.collapse_subdomains:
+        log.info('Removed %d records covered by a parent domain from the section "%s".',
+                 merged_count - updated_count, args.section)
+    log.info('Writing data to "%s"...', args.target)
     write_data(data, args.target)
 
     log.info('All done!')
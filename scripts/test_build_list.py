@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tempfile
+import unittest
+
+from unittest import mock
+
+import build_list
+
+
+class CompileSubsTest(unittest.TestCase):
+    def test_single_byte_key_inside_longer_key(self) -> None:
+        subs = build_list.compile_subs({'[.]': '.', '[': 'x'})
+
+        self.assertEqual(build_list.parse_line(b'a[.]com', subs), b'a.com')
+        self.assertEqual(build_list.parse_line(b'a[com', subs), b'axcom')
+
+    def test_translate_table(self) -> None:
+        subs = build_list.compile_subs({'[.]': '.', '_': '-'})
+
+        self.assertEqual(subs.table, bytes.maketrans(b'_', b'-'))
+        self.assertEqual(build_list.parse_line(b'a_b[.]com rest\n', subs), b'a-b.com')
+
+
+class ParseTargetRoundTripTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp = tmp_dir.name
+        self.target = os.path.join(self.tmp, 'out.txt')
+
+        subs = os.path.join(self.tmp, 'subs.json')
+        with open(subs, 'w') as f:
+            f.write('{"[.]": "."}')
+        for name, value in (('SUBS', subs), ('LOG_FILE', os.path.join(self.tmp, 'build_list.log'))):
+            patcher = mock.patch.object(build_list, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self) -> None:
+        # release the log file handle before the temporary directory is removed
+        for handler in build_list.logging.root.handlers[:]:
+            handler.close()
+            build_list.logging.root.removeHandler(handler)
+
+    def run_update(self, section: str, *hosts: str, collapse: bool = False) -> dict:
+        source = os.path.join(self.tmp, 'update.txt')
+        with open(source, 'w') as f:
+            f.writelines(f'{host}\n' for host in hosts)
+
+        argv = ['build_list.py', '-f', source, '-s', section, '-t', self.target, '--run']
+        if collapse:
+            argv.append('--collapse-subdomains')
+        with mock.patch.object(sys, 'argv', argv):
+            build_list.main()
+        return build_list.parse_target(self.target)
+
+    def test_multi_word_section_round_trip(self) -> None:
+        self.run_update('My Section', 'a.com')
+        data = self.run_update('My Section', 'b[.]com')
+
+        self.assertEqual(list(data), ['My Section'])
+        self.assertEqual(data['My Section']['items'], [b'a.com', b'b.com'])
+
+    def test_irregular_header_is_kept(self) -> None:
+        with open(self.target, 'wb') as f:
+            f.write(b'\n### Scam  domains start\n# comment\n\nscam.com\n\n### Scam domains end\n'
+                    b'\n#### Foo domains start\n\nfoo.com\n\n### Foo domains end\n'
+                    b'\n### domains start\n\nnameless.com\n\n### domains end\n')
+        data = self.run_update('Other', 'other.com')
+
+        self.assertEqual(list(data), ['Scam', 'Foo', 'Other'])
+        self.assertEqual(data['Scam'], {'items': [b'scam.com'], 'comments': [b'# comment']})
+        self.assertEqual(data['Foo']['items'], [b'foo.com'])
+        self.assertEqual(data['Other']['items'], [b'other.com'])
+
+    def test_collapse_subdomains_without_new_records(self) -> None:
+        self.run_update('Scam', 'example.com', 'foo.example.com')
+        data = self.run_update('Scam', 'example.com', collapse=True)
+
+        self.assertEqual(data['Scam']['items'], [b'example.com'])
+
+
+class MergeEntriesTest(unittest.TestCase):
+    def assert_merged(self, items: list, new_entries: set, expected: list) -> None:
+        self.assertEqual(build_list.merge_entries(items, new_entries), expected)
+        # the same items in the other order go through the other branch and have to give the same result
+        self.assertEqual(build_list.merge_entries(items[::-1], new_entries), expected)
+
+    def test_sorted_items_with_duplicates(self) -> None:
+        self.assert_merged([b'a.com', b'b.com', b'b.com', b'd.com'], {b'a.com', b'c.com', b'e.com'},
+                           [b'a.com', b'b.com', b'c.com', b'd.com', b'e.com'])
+
+    def test_unsorted_items(self) -> None:
+        self.assert_merged([b'd.com', b'a.com', b'a.com'], {b'c.com', b'd.com'}, [b'a.com', b'c.com', b'd.com'])
+
+    def test_empty(self) -> None:
+        self.assert_merged([], {b'b.com', b'a.com'}, [b'a.com', b'b.com'])
+        self.assert_merged([b'a.com', b'b.com'], set(), [b'a.com', b'b.com'])
+        self.assert_merged([b'b.com', b'a.com'], set(), [b'a.com', b'b.com'])
+        self.assert_merged([], set(), [])
+
+
+class CollapseSubdomainsTest(unittest.TestCase):
+    def test_multi_level_subdomain_is_dropped(self) -> None:
+        entries = [b'a.b.example.com', b'example.com', b'x.example.org']
+
+        self.assertEqual(build_list.collapse_subdomains(entries), [b'example.com', b'x.example.org'])
+
+    def test_suffix_sibling_is_kept(self) -> None:
+        # only whole labels count, a shared string suffix does not make a parent
+        entries = [b'ample.com', b'com.x', b'example.com', b'x.com.x', b'xcom.x']
+
+        self.assertEqual(build_list.collapse_subdomains(entries), [b'ample.com', b'com.x', b'example.com', b'xcom.x'])
+
+    def test_trailing_dot(self) -> None:
+        entries = [b'crowdpass.', b'crowdpass.com', b'www.crowdpass.']
+
+        self.assertEqual(build_list.collapse_subdomains(entries), [b'crowdpass.', b'crowdpass.com'])
+
+
+if __name__ == '__main__':
+    unittest.main()